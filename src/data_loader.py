@@ -1,21 +1,243 @@
+from __future__ import annotations
+
+import ast
 import json
-import pandas as pd
 import os
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, FrozenSet, Iterable, Iterator, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # pandas takes a noticeable time to import, so it is only imported at runtime once it is needed
+    import pandas as pd
+
+try:
+    import orjson # Optional: parses AtomicCards.json several times faster than the json module
+except ImportError:
+    orjson = None
 
 # --- Configuration ---
 # Define the root directory and file paths
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
 DATA_FILE_PATH = DATA_DIR / "AtomicCards.json"
-OUTPUT_FILE_PATH = DATA_DIR / "commander_legal_cards.csv"
+OUTPUT_FILE_PATH = DATA_DIR / "commander_legal_cards.parquet"
+LEGACY_OUTPUT_FILE_PATH = DATA_DIR / "commander_legal_cards.csv" # Older CSV cache, still read if no Parquet cache exists
 COLLECTION_FILE_PATH = DATA_DIR / "1125_collection.csv" # New path for the user's collection
 
-def load_and_preprocess_data() -> Optional[pd.DataFrame]:
+# Columns the rest of the app actually reads from the card database
+LOADED_COLUMNS = ['Name', 'ColorIdentity', 'ManaValue', 'Type', 'Text', 'Keywords']
+# Number of cards flattened into each DataFrame batch while building the database
+BATCH_SIZE = 4096
+# Low-cardinality text columns, stored as categoricals to shrink the cache and memory use
+CATEGORICAL_DTYPES = {'ColorIdentity': 'category', 'CommanderLegality': 'category'}
+# Free-text columns, stored as contiguous Arrow strings instead of one Python object per cell
+STRING_DTYPES = {
+    'Name': 'string[pyarrow]', 'Text': 'string[pyarrow]', 'Type': 'string[pyarrow]', 'Keywords': 'string[pyarrow]',
+}
+
+class CardDataDecodeError(ValueError):
+    """Raised when AtomicCards.json cannot be parsed as JSON."""
+
+# Successfully loaded data, memoized so repeated calls in one session skip the disk.
+# Failed loads are never stored, so a later call can retry once the files are fixed.
+_LOAD_CACHE: Dict[str, Any] = {}
+
+# One bit per color, so a color identity packs into a small integer mask
+COLOR_BITS = {'W': 1, 'U': 2, 'B': 4, 'R': 8, 'G': 16}
+
+def color_identity_mask(color_identity: str) -> int:
+    """
+    Encodes a color identity string (e.g. 'BR', or 'C' for colorless) as a 5-bit mask.
+    A card fits under a commander when (card_mask & ~commander_mask) == 0.
+    """
+    return sum(COLOR_BITS.get(color, 0) for color in set(str(color_identity)))
+
+def _normalize_legacy_columns(card_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The old CSV cache stored list columns as their Python repr (e.g. "['B', 'R']").
+    Converts ColorIdentity to the joined string form ('BR', or 'C' when colorless) and
+    Keywords to the comma-joined string used by fresh builds, so every load path
+    hands the rest of the app the same representation.
+    """
+    # Only a few dozen distinct identities exist, so normalize each once and map them back
+    identities = {
+        raw: "".join(sorted(color for color in str(raw) if color in COLOR_BITS)) or 'C'
+        for raw in card_df['ColorIdentity'].unique()
+    }
+    # Keyword lists repeat a lot too; each distinct repr is decoded (not stripped of quotes,
+    # which would also drop apostrophes like "Doctor's companion") and mapped back
+    keywords = {raw: _join_legacy_list(raw) for raw in card_df['Keywords'].unique()}
+    return card_df.assign(
+        ColorIdentity=card_df['ColorIdentity'].map(identities),
+        Keywords=card_df['Keywords'].map(keywords),
+    )
+
+def _join_legacy_list(raw: Any) -> str:
+    """Decodes one list repr from the old CSV cache (e.g. "['Fight', 'Haste']") into 'Fight, Haste'."""
+    if not isinstance(raw, str):
+        return '' # NaN: the card has no keywords
+    try:
+        values = ast.literal_eval(raw)
+    except (ValueError, SyntaxError):
+        return raw # Not a list repr, so it is already a plain string
+    if not isinstance(values, (list, tuple)):
+        return raw
+    return ", ".join(str(value) for value in values)
+
+def _prepare_card_database(card_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Final in-memory preparation shared by every load path. Indexes the database by card
+    name (keeping the 'Name' column) so single-card lookups, like finding the commander,
+    are hash lookups, and precomputes the columns used by every strategy query.
+    """
+    # The index is left unnamed so 'Name' never becomes ambiguous between index and column
+    card_df = card_df.drop_duplicates(subset=['Name']).set_index('Name', drop=False).rename_axis(None)
+
+    # The legacy CSV cache comes back as plain Python strings, so make sure the categorical
+    # and Arrow string dtypes are applied on every path (a no-op for the Parquet cache)
+    column_dtypes = {**CATEGORICAL_DTYPES, **STRING_DTYPES}
+    card_df = card_df.astype({col: dtype for col, dtype in column_dtypes.items() if col in card_df.columns})
+    card_df = card_df.assign(Text=card_df['Text'].fillna(''))
+
+    # Lowercased "Name Text" searched by keyword scoring, built once instead of per query.
+    # Built from Arrow strings, the concatenation and lowercasing run as native kernels.
+    search_blob = (card_df['Name'].fillna('') + " " + card_df['Text']).str.lower()
+    # Color identity bitmask for the on-color filter (mapped per category, not per row)
+    color_mask = card_df['ColorIdentity'].map(color_identity_mask).astype('int8')
+    return card_df.assign(_search_blob=search_blob, _ci_mask=color_mask)
+
+def _iter_atomic_cards(low_memory: bool = False) -> Iterator[Tuple[str, Any]]:
+    """
+    Yields (card name, card details) pairs from AtomicCards.json. By default the whole
+    file is parsed at once (with orjson when available). With low_memory=True and ijson
+    installed, cards are streamed one at a time so the full dict is never held in memory.
+    Raises CardDataDecodeError if the file cannot be decoded.
+    """
+    if low_memory:
+        try:
+            import ijson
+        except ImportError:
+            print("Warning: ijson is not installed. Parsing the whole JSON file instead.")
+        else:
+            with open(DATA_FILE_PATH, 'rb') as f:
+                try:
+                    yield from ijson.kvitems(f, 'data', use_float=True)
+                except ijson.JSONError as e:
+                    raise CardDataDecodeError(str(e)) from e
+            return
+
+    # Only the parse itself is guarded, so errors from building the DataFrame are not misreported
+    try:
+        if orjson is not None:
+            data: Dict[str, Any] = orjson.loads(DATA_FILE_PATH.read_bytes())
+        else:
+            with open(DATA_FILE_PATH, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+    except ValueError as e: # json/orjson JSONDecodeError and UnicodeDecodeError are all ValueErrors
+        raise CardDataDecodeError(str(e)) from e
+
+    # MTGJSON structure is: { 'meta': {...}, 'data': { 'Card Name': [{...}], ... } }
+    yield from data.get('data', {}).items()
+
+def _build_card_dataframe(cards: Iterable[Tuple[str, Any]]) -> pd.DataFrame:
+    """
+    Flattens only the fields we use from each MTGJSON card in a single pass, skipping
+    non-Commander-legal cards before they are materialized (much cheaper than
+    pd.json_normalize on every card). Cards are converted to compact DataFrame batches
+    of BATCH_SIZE rows as they go, which caps peak memory on the first-run build.
+    """
+    import pandas as pd
+
+    print("Extracting Commander-legal cards...")
+    column_names = [
+        'Name', 'ColorIdentity', 'ManaValue', 'Type', 'Text',
+        'Keywords', 'Power', 'Toughness', 'CommanderLegality',
+    ]
+    columns: Dict[str, List[Any]] = {name: [] for name in column_names}
+    batches: List[pd.DataFrame] = []
+    legal_cards = 0
+    total_cards = 0
+    for card_name, details in cards:
+        card_details = details[0] if isinstance(details, list) and details else details
+        if not isinstance(card_details, dict):
+            continue
+        total_cards += 1
+
+        # Filter for Commander Legality
+        commander_legality = (card_details.get('legalities') or {}).get('commander')
+        if commander_legality != 'Legal':
+            continue
+
+        columns['Name'].append(card_name)
+        # --- CRITICAL FIX FOR COLOR IDENTITY ---
+        # This fixes the bug where cards like Krenko were read as Colorless ('C').
+        # It converts the list of colors (e.g., ['R']) into a joined string ('R').
+        color_identity = card_details.get('colorIdentity')
+        columns['ColorIdentity'].append("".join(sorted(color_identity)) if color_identity else 'C')
+        columns['ManaValue'].append(card_details.get('manaValue'))
+        columns['Type'].append(card_details.get('type', ''))
+        columns['Text'].append(card_details.get('text', ''))
+        # Keywords are joined once here, so nothing downstream has to format a list per row
+        columns['Keywords'].append(", ".join(card_details.get('keywords') or []))
+        columns['Power'].append(card_details.get('power', ''))
+        columns['Toughness'].append(card_details.get('toughness', ''))
+        columns['CommanderLegality'].append(commander_legality)
+        legal_cards += 1
+
+        # Hand each full batch over to Arrow-backed strings and release the Python objects
+        if len(columns['Name']) >= BATCH_SIZE:
+            batches.append(pd.DataFrame(columns).astype(STRING_DTYPES))
+            columns = {name: [] for name in column_names}
+            print(f"  ...{legal_cards} Commander-legal cards extracted")
+
+    if columns['Name'] or not batches:
+        batches.append(pd.DataFrame(columns).astype(STRING_DTYPES))
+
+    print(f"\nTotal unique cards loaded: {total_cards}")
+    print(f"Commander-legal cards found: {legal_cards}")
+
+    return pd.concat(batches, ignore_index=True)
+
+def _write_card_cache(card_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Applies the compact column dtypes and saves the card database to the Parquet cache
+    (Parquet keeps the dtypes, unlike CSV). Returns the converted DataFrame; if the cache
+    cannot be written, a warning is printed and the data is still returned for this run.
+    """
+    column_dtypes = {**CATEGORICAL_DTYPES, **STRING_DTYPES}
+    card_df = card_df.astype({col: dtype for col, dtype in column_dtypes.items() if col in card_df.columns})
+    # Write to a temporary file and swap it in atomically, so an interrupted run can
+    # never leave a truncated cache behind for the fast path to load
+    tmp_output_path = OUTPUT_FILE_PATH.with_suffix(OUTPUT_FILE_PATH.suffix + '.tmp')
+    try:
+        card_df.to_parquet(tmp_output_path, compression='zstd', index=False)
+        os.replace(tmp_output_path, OUTPUT_FILE_PATH)
+    except OSError as e:
+        print(f"Warning: Could not save the card cache to '{OUTPUT_FILE_PATH}': {e}")
+        tmp_output_path.unlink(missing_ok=True)
+        return card_df
+
+    print(f"Cleaned data saved to {OUTPUT_FILE_PATH} (for faster loading next time).")
+    return card_df
+
+def load_and_preprocess_data(low_memory: bool = False) -> Optional[pd.DataFrame]:
     """
     Loads AtomicCards.json, flattens the nested structure, and filters 
     for Commander-legal cards, returning a clean Pandas DataFrame.
+    A successful load is cached, so repeated calls return the same DataFrame;
+    after a failure (None) the next call tries again.
+
+    :param low_memory: Stream the JSON card by card (requires ijson) instead of parsing it all at once
+                       (the --low-memory flag of main.py). Only matters when the JSON has to be parsed.
     """
+    if 'card_database' not in _LOAD_CACHE:
+        card_df = _load_card_database(low_memory)
+        if card_df is None:
+            return None
+        _LOAD_CACHE['card_database'] = card_df
+    return _LOAD_CACHE['card_database']
+
+def _load_card_database(low_memory: bool) -> Optional[pd.DataFrame]:
+    """Loads the card database from the freshest available cache, or builds it from the JSON."""
     # 1. Ensure the data directory exists
     DATA_DIR.mkdir(exist_ok=True)
 
@@ -25,108 +247,69 @@ def load_and_preprocess_data() -> Optional[pd.DataFrame]:
         print("Please download AtomicCards.json and place it in the project's 'data/' folder.")
         return None 
 
-    # 3. Check if the pre-processed CSV already exists to speed up loading
+    import pandas as pd
+
+    # 3. Check if the pre-processed cache already exists to speed up loading
     if OUTPUT_FILE_PATH.exists():
         print(f"Loading pre-processed data from {OUTPUT_FILE_PATH}...")
-        return pd.read_csv(OUTPUT_FILE_PATH)
+        return _prepare_card_database(pd.read_parquet(OUTPUT_FILE_PATH, columns=LOADED_COLUMNS))
+
+    if LEGACY_OUTPUT_FILE_PATH.exists():
+        print(f"Loading pre-processed data from {LEGACY_OUTPUT_FILE_PATH}...")
+        legacy_df = pd.read_csv(LEGACY_OUTPUT_FILE_PATH, usecols=LOADED_COLUMNS)
+        # Convert the old cache to Parquet once, so later runs take the fast path above
+        legacy_df = _write_card_cache(_normalize_legacy_columns(legacy_df))
+        return _prepare_card_database(legacy_df)
 
     print(f"Loading raw JSON data from {DATA_FILE_PATH}...")
 
-    # 4. Load the deeply nested JSON data
+    # 4. Parse the JSON and flatten the Commander-legal cards into a DataFrame
     try:
-        with open(DATA_FILE_PATH, 'r', encoding='utf-8') as f:
-            data: Dict[str, Any] = json.load(f)
-    except json.JSONDecodeError:
+        final_df = _build_card_dataframe(_iter_atomic_cards(low_memory))
+    except CardDataDecodeError:
         print(f"Error: Failed to decode JSON from {DATA_FILE_PATH}. File may be corrupted.")
         return None
 
-    # MTGJSON structure is: { 'meta': {...}, 'data': { 'Card Name': [{...}], ... } }
-    card_data: Dict[str, List[Dict[str, Any]]] = data.get('data', {})
-
-    # 5. Flatten the dictionary of cards into a list of card objects
-    card_list: List[Dict[str, Any]] = []
-    for card_name, details in card_data.items():
-        card_details = details[0] if isinstance(details, list) and details else details
-        if not isinstance(card_details, dict):
-            continue
-
-        card_details['card_name'] = card_name
-        card_list.append(card_details)
-
-    # 6. Create the DataFrame and flatten complex nested columns like 'legalities'
-    print("Creating and normalizing DataFrame...")
-    df = pd.json_normalize(card_list)
-
-    # --- Data Cleaning and Commander Filtering ---
-
-    # 7. Filter for Commander Legality
-    if 'legalities.commander' not in df.columns:
-        print("Warning: 'legalities.commander' column not found. Skipping legality filter.")
-        commander_legal_df = df.copy()
-    else:
-        commander_legal_df = df[df['legalities.commander'] == 'Legal'].copy().dropna(subset=['legalities.commander'])
-
-    print(f"\nTotal unique cards loaded: {len(df)}")
-    print(f"Commander-legal cards found: {len(commander_legal_df)}")
-
-    # 8. Select and rename core columns for easier coding later
-    final_columns = {
-        'card_name': 'Name',
-        'colorIdentity': 'ColorIdentity',
-        'manaValue': 'ManaValue',
-        'type': 'Type',
-        'text': 'Text',
-        'keywords': 'Keywords',
-        'power': 'Power',
-        'toughness': 'Toughness',
-        'legalities.commander': 'CommanderLegality',
-    }
-
-    # Select columns safely and rename them
-    cols_to_keep = [col for col, new_name in final_columns.items() if col in commander_legal_df.columns]
-    final_df = commander_legal_df[cols_to_keep].rename(columns={col: final_columns[col] for col in cols_to_keep})
-
-    # --- CRITICAL FIX FOR COLOR IDENTITY ---
-    # This fixes the bug where cards like Krenko were read as Colorless ('C').
-    # It converts the list of colors (e.g., ['R']) into a joined string ('R').
-    final_df['ColorIdentity'] = final_df['ColorIdentity'].apply(
-        lambda x: "".join(sorted(x)) if isinstance(x, list) and x else 'C'
-    )
-    
-    # Add back any missing core columns (important for later AI features)
-    for new_name in final_columns.values():
-        if new_name not in final_df.columns:
-            default_value = [] if new_name == 'Keywords' else ''
-            final_df[new_name] = default_value
+    # 5. Save the clean, filtered data as Parquet for fast loading in the future
+    final_df = _write_card_cache(final_df)
 
-    # 9. Save the clean, filtered data as a CSV for fast loading in the future
-    final_df.to_csv(OUTPUT_FILE_PATH, index=False)
-    print(f"\nCleaned data saved to {OUTPUT_FILE_PATH} (for faster loading next time).")
+    return _prepare_card_database(final_df[LOADED_COLUMNS])
 
-    return final_df
-
-def load_collection_data() -> Optional[List[str]]:
+def load_collection_data() -> Optional[FrozenSet[str]]:
     """
     Loads card names from the user's local Moxfield CSV file (1125_collection.csv).
-    Returns a list of unique card names owned by the user.
+    Returns a frozenset of unique card names owned by the user. A successful load is
+    cached; a missing or unreadable file returns an empty set and is retried next call.
     """
+    if 'owned_cards' in _LOAD_CACHE:
+        return _LOAD_CACHE['owned_cards']
+
     if not COLLECTION_FILE_PATH.exists():
         print(f"Warning: Collection file not found at '{COLLECTION_FILE_PATH}'. Skipping collection filter.")
-        return []
+        return frozenset()
+
+    import pandas as pd
 
     print(f"Loading user collection from {COLLECTION_FILE_PATH}...")
     try:
-        collection_df = pd.read_csv(COLLECTION_FILE_PATH)
-        
-        # We only need the names of the cards, filtered by having a positive count
-        owned_cards = collection_df[collection_df['Count'] > 0]['Name'].unique().tolist()
+        # We only need the names of the cards, filtered by having a positive count,
+        # so skip parsing every other Moxfield column
+        collection_df = pd.read_csv(
+            COLLECTION_FILE_PATH,
+            usecols=['Name', 'Count'],
+            # Nullable Int32, so a blank Count cell is just a card not counted as owned
+            dtype={'Name': 'string', 'Count': 'Int32'},
+        )
+        owned_mask = collection_df['Count'].gt(0).fillna(False)
+        owned_cards = frozenset(collection_df.loc[owned_mask, 'Name'].dropna().unique())
         
         print(f"✅ User collection loaded. Total unique owned cards: {len(owned_cards)}")
+        _LOAD_CACHE['owned_cards'] = owned_cards
         return owned_cards
 
     except Exception as e:
         print(f"Error loading collection CSV: {e}")
-        return []
+        return frozenset()
 
 if __name__ == "__main__":
     # This ensures that when the script is run directly, it will load the data.
@@ -1,5 +1,7 @@
 import requests
 import json
+import os
+from pathlib import Path
 from typing import List, Dict, Any, Optional
 import re
 
@@ -9,6 +11,53 @@ OLLAMA_URL = "http://localhost:11434/api/generate"
 # Define the models for their specific roles
 DEEPSEEK_MODEL = "deepseek-coder:6.7b" # Best for structured/coding-related tasks
 MISTRAL_MODEL = "mistral" # Best for general-purpose reasoning/strategy deduction
+# How long Ollama keeps the model loaded after a request, avoiding a reload on the next call
+OLLAMA_KEEP_ALIVE = "30m"
+
+# Strategy commands already generated, keyed by model and commander, so re-runs skip the LLM call
+STRATEGY_CACHE_PATH = Path(__file__).resolve().parent.parent / "data" / "strategy_cache.json"
+
+# Matches a streamed buffer that currently ends with a closing brace (a possible complete command)
+_CLOSING_BRACE_RE = re.compile(r'\}\s*$')
+
+# In-memory copy of the strategy cache file, read from disk once on first use
+_STRATEGY_CACHE: Optional[Dict[str, Any]] = None
+
+def _load_strategy_cache() -> Dict[str, Any]:
+    """
+    Returns the in-memory strategy cache, reading the file once per process. Later
+    lookups and updates go through this dict; a missing or unreadable file starts an
+    empty cache.
+    """
+    global _STRATEGY_CACHE
+    if _STRATEGY_CACHE is not None:
+        return _STRATEGY_CACHE
+
+    _STRATEGY_CACHE = {}
+    if not STRATEGY_CACHE_PATH.exists():
+        return _STRATEGY_CACHE
+
+    try:
+        with open(STRATEGY_CACHE_PATH, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Warning: Could not read strategy cache at '{STRATEGY_CACHE_PATH}' ({e}). Starting a new one.")
+        return _STRATEGY_CACHE
+
+    if isinstance(cache, dict):
+        _STRATEGY_CACHE = cache
+    return _STRATEGY_CACHE
+
+def _save_strategy_cache(cache: Dict[str, Any]) -> None:
+    """Writes the strategy cache to disk atomically (temporary file, then os.replace)."""
+    tmp_cache_path = STRATEGY_CACHE_PATH.with_suffix(STRATEGY_CACHE_PATH.suffix + '.tmp')
+    try:
+        STRATEGY_CACHE_PATH.parent.mkdir(exist_ok=True)
+        with open(tmp_cache_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_cache_path, STRATEGY_CACHE_PATH)
+    except OSError as e:
+        print(f"Warning: Could not save strategy cache to '{STRATEGY_CACHE_PATH}': {e}")
 
 class OllamaAgent:
     """
@@ -17,40 +66,92 @@ class OllamaAgent:
     # Initialize with the strategy model (Mistral) as default for the main task
     def __init__(self, strategy_model_name: str = MISTRAL_MODEL):
         self.strategy_model_name = strategy_model_name
+        # Reuse one pooled HTTP connection to the local Ollama server across calls
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+
+    def _is_valid_command(self, command: Any) -> bool:
+        """Basic validation to ensure the decoded JSON looks like a command."""
+        return (isinstance(command, dict) and 
+                'function' in command and 
+                'strategy' in command and 
+                'keywords' in command and # Check for new keywords field
+                isinstance(command['keywords'], list)) # Ensure keywords is a list
 
     def _parse_json_response(self, text: str) -> Optional[Dict[str, Any]]:
         """
         Extracts and parses the command JSON object from the LLM's response.
         We now expect: {"function": "select_cards", "strategy": "Goblin Tribal", "keywords": ["Goblin", "Token", "Haste"]}
         """
-        # Look for a JSON object structure enclosed in curly braces { ... }
-        match = re.search(r'\{[^{}]*\}', text, re.DOTALL)
-        
-        if match:
-            raw_json_str = match.group(0).strip()
-            
-            # 2. Attempt to parse the cleaned string into a Python dictionary
+        # 1. We request "format": "json", so usually the whole response is the command itself
+        try:
+            command = json.loads(text)
+            if self._is_valid_command(command):
+                return command
+        except json.JSONDecodeError:
+            pass
+
+        # 2. Otherwise decode forward from each '{' until a complete command is found
+        # (raw_decode handles nested objects and ignores any trailing prose)
+        decoder = json.JSONDecoder()
+        start = text.find('{')
+        while start != -1:
             try:
-                command = json.loads(raw_json_str)
-                # Basic validation to ensure it looks like a command
-                if (isinstance(command, dict) and 
-                    'function' in command and 
-                    'strategy' in command and 
-                    'keywords' in command and # Check for new keywords field
-                    isinstance(command['keywords'], list)): # Ensure keywords is a list
+                command, _ = decoder.raw_decode(text, start)
+                if self._is_valid_command(command):
                     return command
-            except json.JSONDecodeError as e:
-                print(f"DEBUG: Failed to decode command JSON. Error: {e}")
-                return None
-        
+            except json.JSONDecodeError:
+                pass
+            start = text.find('{', start + 1)
+
         return None
 
-    def get_strategy_command(self, commander_name: str, commander_color_identity: str) -> Optional[Dict[str, Any]]:
+    def _read_streamed_response(self, response: requests.Response) -> str:
+        """
+        Concatenates the streamed response chunks from Ollama. Stops reading as soon as
+        the text so far ends with a complete command object, instead of waiting for the
+        model to finish generating any trailing tokens.
+        """
+        chunks: List[str] = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+
+            chunk = json.loads(line)
+            chunks.append(chunk.get('response', ''))
+            if chunk.get('done'):
+                break
+
+            buffer = ''.join(chunks)
+            if _CLOSING_BRACE_RE.search(buffer) and self._parse_json_response(buffer) is not None:
+                break
+
+        return ''.join(chunks)
+
+    def get_strategy_command(
+        self, 
+        commander_name: str, 
+        commander_color_identity: str, 
+        use_cache: bool = True
+    ) -> Optional[Dict[str, Any]]:
         """
         Queries the LLM for a structured command outlining the deck strategy, 
         including a dedicated list of search keywords.
+
+        Successful commands are cached in memory and in STRATEGY_CACHE_PATH, keyed by model,
+        commander and color identity. With use_cache=False the cached entry is ignored
+        and replaced with a freshly generated one.
         """
-        
+        strategy_cache = _load_strategy_cache()
+        cache_key = f"{self.strategy_model_name}|{commander_name}|{commander_color_identity}"
+        # Entries are checked like a fresh response, so a stale or hand-edited entry is regenerated
+        if use_cache and self._is_valid_command(strategy_cache.get(cache_key)):
+            print(f"Using cached strategy for {commander_name} (run with --no-cache to regenerate).")
+            # Hand out a copy, so callers changing the command (e.g. its keywords) never touch the cache
+            cached = strategy_cache[cache_key]
+            return dict(cached, keywords=list(cached['keywords']))
+
         system_prompt = (
             "You are an expert Magic: The Gathering Commander deck builder. "
             "Your task is to determine the core synergistic strategy and a concise list of 3-5 "
@@ -75,23 +176,29 @@ class OllamaAgent:
         payload = {
             "model": self.strategy_model_name,
             "prompt": f"{system_prompt}\n{function_schema}\n\nUSER COMMAND: {user_prompt}",
-            "stream": False,
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
             "format": "json", 
             "options": {
                 "temperature": 0.1, 
-                "num_predict": 1024
+                # The command JSON is well under 100 tokens; a tight cap bounds generation time
+                # if the model starts rambling instead of closing the object
+                "num_predict": 256
             }
         }
 
         try:
-            response = requests.post(OLLAMA_URL, json=payload, timeout=30)
-            response.raise_for_status()
-            
-            response_json = response.json()
-            full_response_text = response_json.get('response', '')
+            # Closing the stream early (once the command is complete) also stops generation
+            with self.session.post(OLLAMA_URL, json=payload, timeout=30, stream=True) as response:
+                response.raise_for_status()
+                full_response_text = self._read_streamed_response(response)
             
             # Parse the response to extract the command
-            return self._parse_json_response(full_response_text)
+            command = self._parse_json_response(full_response_text)
+            if command is not None:
+                strategy_cache[cache_key] = dict(command, keywords=list(command['keywords']))
+                _save_strategy_cache(strategy_cache)
+            return command
 
         except requests.exceptions.ConnectionError:
             print(f"❌ ERROR: Could not connect to Ollama server at {OLLAMA_URL}.")
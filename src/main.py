@@ -1,26 +1,133 @@
-import pandas as pd
-from typing import Optional, List, Dict, Any
-import random
-import re
-import string
+from __future__ import annotations
+
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, FrozenSet, Iterable, Tuple, TYPE_CHECKING
+import sys
 
 # Relative import structure for modules inside the 'src/' folder
-from data_loader import load_and_preprocess_data, load_collection_data
-from llm_agent import OllamaAgent
+from data_loader import load_and_preprocess_data, load_collection_data, color_identity_mask
+
+if TYPE_CHECKING:
+    # pandas/numpy are only needed once cards are being ranked, so they are imported lazily
+    import numpy as np
+    import pandas as pd
 
 # --- HYPOTHETICAL PRICE DATA ---
 # Since we don't have real card price data, we will use a small list of known 
 # expensive Krenko staples to simulate the "Pricier" category for demonstration.
-PRICEY_CARDS = {
+PRICEY_CARDS = frozenset({
     "Goblin Piledriver", "Kiki-Jiki, Mirror Breaker", "Gilded Drake", 
     "Imperial Recruiter", "Ancient Tomb", "Sneak Attack", "Chandra's Ignition"
-}
+})
+
+# --- QUERY CACHE ---
+# Memo for strategy queries against one card database. Commander has only 32 possible
+# color identities, so each on-color filter is computed once and reused afterwards.
+# Keywords are memoized too: each one owns a bit of a per-card uint64 mask, so at most
+# MAX_CACHED_KEYWORDS can be held before the keyword memo starts over.
+MAX_CACHED_KEYWORDS = 64
+_QUERY_CACHE: Dict[str, Any] = {}
+
+def _query_cache(card_database_df: pd.DataFrame) -> Dict[str, Any]:
+    """Returns the memo tied to this card database, starting a fresh one if the database changed."""
+    if _QUERY_CACHE.get('source') is not card_database_df:
+        _QUERY_CACHE.clear()
+        _QUERY_CACHE['source'] = card_database_df
+    return _QUERY_CACHE
+
+def legal_pool_mask(card_database_df: pd.DataFrame, commander_color_identity: str) -> np.ndarray:
+    """
+    Returns a boolean mask of the cards within the commander's color identity. The mask
+    is memoized per color identity, so repeated queries skip the color filter entirely.
+    """
+    color_masks: Dict[str, Any] = _query_cache(card_database_df).setdefault('color_masks', {})
+
+    if commander_color_identity not in color_masks:
+        # A card is on-color when none of its color bits fall outside the commander's mask
+        # (colorless cards have no bits), checked as one vectorized AND over the column.
+        if '_ci_mask' in card_database_df.columns:
+            card_masks = card_database_df['_ci_mask'].to_numpy()
+        else:
+            card_masks = card_database_df['ColorIdentity'].map(color_identity_mask).to_numpy(dtype='int8')
+        commander_mask = color_identity_mask(commander_color_identity)
+        color_masks[commander_color_identity] = (card_masks & ~commander_mask) == 0
+
+    return color_masks[commander_color_identity]
+
+def keyword_bitmasks(card_database_df: pd.DataFrame, keywords: List[str]) -> Tuple[np.ndarray, Dict[int, int]]:
+    """
+    Returns the per-card uint64 masks of which memoized keywords appear in each card's
+    Name or Text, plus the query masks for the given (lowercase) keywords, keyed by how
+    many times each keyword is listed. Only keywords not seen before cost a substring
+    scan over the database.
+    """
+    import numpy as np
+
+    cache = _query_cache(card_database_df)
+    keyword_bits: Dict[str, int] = cache.setdefault('keyword_bits', {})
+    keyword_counts = Counter(keywords)
+    keywords = list(keyword_counts)
+    if len(keywords) > MAX_CACHED_KEYWORDS:
+        print(f"Warning: Only the first {MAX_CACHED_KEYWORDS} distinct keywords are scored. Ignoring: {keywords[MAX_CACHED_KEYWORDS:]}")
+        keywords = keywords[:MAX_CACHED_KEYWORDS]
+
+    new_keywords = [keyword for keyword in keywords if keyword not in keyword_bits]
+    if len(keyword_bits) + len(new_keywords) > MAX_CACHED_KEYWORDS:
+        # Out of bits: start the keyword memo over with just this query's keywords
+        keyword_bits.clear()
+        cache.pop('keyword_masks', None)
+        new_keywords = keywords
+
+    card_masks = cache.get('keyword_masks')
+    if card_masks is None:
+        card_masks = cache['keyword_masks'] = np.zeros(len(card_database_df), dtype=np.uint64)
+
+    if new_keywords:
+        if '_search_blob' in card_database_df.columns:
+            search_blob = card_database_df['_search_blob']
+        else:
+            search_blob = (card_database_df['Name'].fillna('') + " " + card_database_df['Text'].fillna('')).str.lower()
+
+        def scan(keyword: str) -> np.ndarray:
+            return search_blob.str.contains(keyword, regex=False, na=False).to_numpy(dtype=bool)
+
+        # The scans are independent and Arrow's string kernels release the GIL, so several
+        # new keywords are scanned on parallel threads; the masks are then ORed in one by one
+        workers = min(len(new_keywords), os.cpu_count() or 1)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                keyword_hits = list(executor.map(scan, new_keywords))
+        else:
+            keyword_hits = [scan(keyword) for keyword in new_keywords]
+
+        for keyword, has_keyword in zip(new_keywords, keyword_hits):
+            bit = len(keyword_bits)
+            card_masks[has_keyword] |= np.uint64(1 << bit)
+            keyword_bits[keyword] = bit
+
+    query_masks: Dict[int, int] = {}
+    for keyword in keywords:
+        count = keyword_counts[keyword]
+        query_masks[count] = query_masks.get(count, 0) | (1 << keyword_bits[keyword])
+    return card_masks, query_masks
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    """Counts the set bits of each uint64 value."""
+    import numpy as np
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy < 2.0 has no bitwise_count: count the set bits of each value's 8 bytes instead
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
 
 def select_cards_by_strategy(
     card_database_df: pd.DataFrame, 
     strategy_keywords: List[str], 
     commander_color_identity: str, 
-    owned_cards: List[str]
+    owned_cards: Iterable[str]
 ) -> Dict[str, List[str]]:
     """
     Filters the card DataFrame for cards matching the AI-deduced keywords, ranks them
@@ -29,77 +136,73 @@ def select_cards_by_strategy(
     :param card_database_df: The DataFrame containing all legal MTG cards.
     :param strategy_keywords: The list of clean keywords provided by the AI (e.g., ['Goblin', 'Token', 'Haste']).
     :param commander_color_identity: The color identity string (e.g., 'R', 'UB').
-    :param owned_cards: A list of unique card names owned by the user.
+    :param owned_cards: The unique card names owned by the user (a set or any iterable).
     :return: A dictionary with keys 'owned', 'missing_budget', and 'missing_pricier'.
     """
+    import numpy as np
+
     print(f"Executing Strategy Query: Finding and ranking top cards matching keywords: {strategy_keywords} in {commander_color_identity}.")
     
+    # Hash the collection once so every ownership check below is O(1), even if a plain list was passed
+    owned_set = frozenset(owned_cards)
+
     # 1. Keyword Standardization
     strategy_keywords = [word.lower() for word in strategy_keywords if word and len(word) > 1]
     if not strategy_keywords:
         return {'owned': [], 'missing_budget': [], 'missing_pricier': []}
 
     # 2. Color Filter (Ensures only on-color cards are considered)
-    def is_within_colors(card_color_identity: str, commander_ci: str) -> bool:
-        return card_color_identity == 'C' or all(color in commander_ci for color in card_color_identity)
-        
-    color_filter = card_database_df['ColorIdentity'].apply(
-        lambda x: is_within_colors(x, commander_color_identity)
-    )
-    
-    # Start with the color-filtered DataFrame
-    synergy_cards_df = card_database_df[color_filter].copy()
+    color_filter = legal_pool_mask(card_database_df, commander_color_identity)
     
     # 3. Keyword Scoring (The new ranking mechanism)
+    # Every card carries a bitmask of the keywords found in its Name or Text. A card scores
+    # one point per keyword in the list it matches, which is the popcount of its mask ANDed
+    # with the query bits (one popcount per repeat count, weighted by it, so a keyword listed
+    # twice scores twice); a card with no bits left is pruned before anything is copied.
+    card_keyword_masks, query_masks = keyword_bitmasks(card_database_df, strategy_keywords)
+    query_mask = 0
+    for weight_mask in query_masks.values():
+        query_mask |= weight_mask
+    matched_bits = card_keyword_masks & np.uint64(query_mask)
+    candidates = color_filter & (matched_bits != 0)
+    matched_bits = matched_bits[candidates]
+    score = np.zeros(len(matched_bits), dtype=np.int32)
+    for weight, weight_mask in query_masks.items():
+        score += weight * _popcount(matched_bits & np.uint64(weight_mask)).astype(np.int32)
+
+    # Only the columns needed for ranking are taken; boolean .loc already returns new data,
+    # and every later step uses .assign, so no extra .copy() is needed
+    synergy_cards_df = card_database_df.loc[candidates, ['Name', 'ManaValue']].assign(Score=score)
     
-    def score_card(card_row: pd.Series, keywords: List[str]) -> int:
-        """Scores a card based on how many keywords appear in its Name or Text."""
-        score = 0
-        card_text = str(card_row['Name']) + " " + str(card_row['Text'])
-        card_text_lower = card_text.lower()
-        
-        for keyword in keywords:
-            if keyword in card_text_lower:
-                score += 1
-        return score
-
-    # Apply the scoring function to the filtered DataFrame
-    synergy_cards_df['Score'] = synergy_cards_df.apply(
-        lambda row: score_card(row, strategy_keywords), axis=1
-    )
-    
-    # Filter out cards with a score of 0 and non-card entities
-    synergy_cards_df = synergy_cards_df[synergy_cards_df['Score'] > 0]
+    # Filter out non-card entities
     synergy_cards_df = synergy_cards_df[~synergy_cards_df['Name'].isin(["Token", "Emblem", "Scheme", "Krenko, Mob Boss"])]
 
     # 4. Final Ranking and Categorization
     
-    # Sort: Highest Score first, then lowest ManaValue (for efficiency), then random shuffle for ties
-    synergy_cards_df = synergy_cards_df.sort_values(
-        by=['Score', 'ManaValue'], 
-        ascending=[False, True]
-    ).sample(frac=1).sort_values(by=['Score', 'ManaValue'], ascending=[False, True])
-    
-    
-    all_suggestions = synergy_cards_df['Name'].unique().tolist()
-    
-    owned = []
-    missing_budget = []
-    missing_pricier = []
+    # Sort: Highest Score first, then lowest ManaValue (for efficiency), then a random
+    # tiebreaker column so equally ranked cards come out in random order, in one sort
+    random_tiebreak = np.random.default_rng().random(len(synergy_cards_df), dtype=np.float32)
+    synergy_cards_df = synergy_cards_df.assign(_rand=random_tiebreak).sort_values(
+        by=['Score', 'ManaValue', '_rand'], 
+        ascending=[False, True, True],
+        kind='stable'
+    )
     
-    # Separate the list into categories
-    for card_name in all_suggestions:
-        if card_name in owned_cards:
-            if len(owned) < 10: # Limit owned suggestions
-                owned.append(card_name)
-        else:
-            # Categorize missing cards based on the hypothetical price list
-            if card_name in PRICEY_CARDS:
-                if len(missing_pricier) < 5: # Limit pricier suggestions
-                    missing_pricier.append(card_name)
-            elif len(missing_budget) < 10: # Limit budget suggestions
-                missing_budget.append(card_name)
-                
+    # Keep each name once (at its best rank) so a database with repeated names never
+    # suggests a card twice; done once on the small ranked frame, not per bucket
+    synergy_cards_df = synergy_cards_df.drop_duplicates(subset='Name')
+
+    # Separate the ranked cards into categories with boolean masks (rank order is kept)
+    names = synergy_cards_df['Name']
+    owned_mask = names.isin(owned_set)
+    # Categorize missing cards based on the hypothetical price list
+    pricier_mask = ~owned_mask & names.isin(PRICEY_CARDS)
+    budget_mask = ~(owned_mask | pricier_mask)
+
+    owned = names[owned_mask].head(10).tolist() # Limit owned suggestions
+    missing_budget = names[budget_mask].head(10).tolist() # Limit budget suggestions
+    missing_pricier = names[pricier_mask].head(5).tolist() # Limit pricier suggestions
+
     return {
         'owned': owned,
         'missing_budget': missing_budget,
@@ -116,27 +219,33 @@ def select_commander(card_db: pd.DataFrame) -> Optional[Dict[str, Any]]:
     if not commander_name:
         commander_name = DEFAULT_COMMANDER_NAME
 
-    # Search the database for the Commander
-    commander_card = card_db[card_db['Name'] == commander_name]
-
-    if commander_card.empty:
+    # Look the Commander up in the name-indexed database
+    try:
+        commander_card = card_db.loc[commander_name]
+    except KeyError:
         print(f"Error: Commander '{commander_name}' not found in legal card database.")
         return None
     
-    # Return the first (and hopefully only) match as a dictionary
-    return commander_card.iloc[0].to_dict()
+    # Names are unique in the index, so this is a single row
+    return commander_card.to_dict()
+
+def run_deck_builder_app(use_cache: bool = True, low_memory: bool = False):
+    """
+    Runs the interactive deck builder.
 
-def run_deck_builder_app():
+    :param use_cache: Reuse a previously generated strategy for the same commander instead of querying the LLM.
+    :param low_memory: Stream AtomicCards.json card by card (requires ijson) when the card database has to be built.
+    """
     print("--- MTG Commander AI Deck Builder Starting ---")
 
     # 1. Load Data
-    card_database_df: Optional[pd.DataFrame] = load_and_preprocess_data()
+    card_database_df: Optional[pd.DataFrame] = load_and_preprocess_data(low_memory=low_memory)
     if card_database_df is None:
         print("Application stopped due to data loading error.")
         return
 
     # 2. Load Collection
-    owned_cards: Optional[List[str]] = load_collection_data()
+    owned_cards: Optional[FrozenSet[str]] = load_collection_data()
     if owned_cards is None:
         print("Application stopped due to collection loading error.")
         return
@@ -146,22 +255,20 @@ def run_deck_builder_app():
     if commander_card is None:
         return
 
-    # Display Confirmation
-    # FIX for Color Identity Display
-    color_id_display = commander_card['ColorIdentity']
-    if isinstance(color_id_display, list):
-        color_id_display = "".join(color_id_display) 
-
-    print(f"\nCommander Selected: {commander_card['Name']} | Colors: {color_id_display}")
+    # Display Confirmation (ColorIdentity is always a joined string like 'BR' after loading)
+    print(f"\nCommander Selected: {commander_card['Name']} | Colors: {commander_card['ColorIdentity']}")
     print("\n--- Starting AI Card Suggestion Process ---")
 
     # 4. Initialize AI Agent and get the Strategy Command
+    # (imported here so runs that stop earlier never pay for loading requests)
+    from llm_agent import OllamaAgent
     agent = OllamaAgent()
     
     # Get the strategy from the AI (now includes keywords list)
     strategy_command = agent.get_strategy_command(
         commander_name=commander_card['Name'],
-        commander_color_identity=commander_card['ColorIdentity']
+        commander_color_identity=commander_card['ColorIdentity'],
+        use_cache=use_cache
     )
     
     suggested_cards_dict = None
@@ -183,39 +290,52 @@ def run_deck_builder_app():
         print("❌ AI failed to generate a valid strategy command. Check Ollama logs.")
 
     # 6. Display Results
-    print("\n--- AI Card Suggestion Summary ---")
+    # The summary is collected into one list and written to stdout in a single call
+    lines: List[str] = ["\n--- AI Card Suggestion Summary ---"]
     if suggested_cards_dict:
-        print(f"Strategy Determined by AI: **{strategy}**")
+        lines.append(f"Strategy Determined by AI: **{strategy}**")
         
         # 6a. Owned Cards
         owned = suggested_cards_dict.get('owned', [])
         if owned:
-            print(f"\n## ✅ Top Owned Cards ({len(owned)} suggestions)")
-            print("These are the most relevant cards currently in your collection:")
-            for i, card_name in enumerate(owned, 1):
-                print(f" {i}. **{card_name}**")
+            lines.append(f"\n## ✅ Top Owned Cards ({len(owned)} suggestions)")
+            lines.append("These are the most relevant cards currently in your collection:")
+            lines.extend(f" {i}. **{card_name}**" for i, card_name in enumerate(owned, 1))
         else:
-            print("\n## ❌ No owned cards match the derived strategy.")
+            lines.append("\n## ❌ No owned cards match the derived strategy.")
             
         # 6b. Missing Cards (Budget)
         budget = suggested_cards_dict.get('missing_budget', [])
         if budget:
-            print(f"\n## 🛒 Budget Card Singles to Look Out For ({len(budget)} suggestions)")
-            print("These are highly synergistic, budget-friendly cards that are missing from your collection:")
-            for i, card_name in enumerate(budget, 1):
-                print(f" {i}. **{card_name}**")
+            lines.append(f"\n## 🛒 Budget Card Singles to Look Out For ({len(budget)} suggestions)")
+            lines.append("These are highly synergistic, budget-friendly cards that are missing from your collection:")
+            lines.extend(f" {i}. **{card_name}**" for i, card_name in enumerate(budget, 1))
                 
         # 6c. Missing Cards (Pricier)
         pricier = suggested_cards_dict.get('missing_pricier', [])
         if pricier:
-            print(f"\n## 💎 Pricier Upgrade Options ({len(pricier)} suggestions)")
-            print("These are powerful staples for this strategy that would significantly upgrade your deck:")
-            for i, card_name in enumerate(pricier, 1):
-                print(f" {i}. **{card_name}**")
+            lines.append(f"\n## 💎 Pricier Upgrade Options ({len(pricier)} suggestions)")
+            lines.append("These are powerful staples for this strategy that would significantly upgrade your deck:")
+            lines.extend(f" {i}. **{card_name}**" for i, card_name in enumerate(pricier, 1))
                 
-        print("\n✅ Deck building assistance complete.")
+        lines.append("\n✅ Deck building assistance complete.")
     else:
-        print("❌ AI suggestion failed or returned an empty list.")
+        lines.append("❌ AI suggestion failed or returned an empty list.")
+
+    sys.stdout.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
-    run_deck_builder_app()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MTG Commander AI Deck Builder")
+    parser.add_argument(
+        "--no-cache", 
+        action="store_true", 
+        help="Ignore cached AI strategies and query the model again."
+    )
+    parser.add_argument(
+        "--low-memory", 
+        action="store_true", 
+        help="Stream AtomicCards.json card by card (requires ijson) when building the card database."
+    )
+    args = parser.parse_args()
+
+    run_deck_builder_app(use_cache=not args.no_cache, low_memory=args.low_memory)
\ No newline at end of file